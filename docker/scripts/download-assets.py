@@ -4,45 +4,135 @@ Downloads OpenFreeMap assets (fonts, styles, sprites)
 Supports configurable CDN URL via ASSETS_CDN_URL environment variable
 """
 import os
+import re
+import shutil
 import subprocess
 import sys
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
-def download_file(url, output_path):
-    """Download a file using aria2c"""
-    print(f"Downloading: {url}")
-    
-    output_path = Path(output_path)
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    
-    cmd = [
-        'aria2c',
-        '--max-connection-per-server=8',
-        '--split=8',
-        '--min-split-size=1M',
-        '--file-allocation=none',
-        '--console-log-level=warn',
-        '--summary-interval=5',
-        '--download-result=hide',
-        '-d', str(output_path.parent),
-        '-o', output_path.name,
-        url
-    ]
-    subprocess.run(cmd, check=True)
-
-
-def extract_tar_gz(archive_path, output_dir):
-    """Extract a tar.gz archive"""
-    print(f"Extracting: {archive_path}")
-    subprocess.run([
-        'tar',
-        '-xzf',
-        str(archive_path),
-        '-C',
-        str(output_dir)
-    ], check=True)
+# Shared session so metadata requests reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=0.3)
+))
+
+MAX_PARALLEL_DOWNLOADS = int(os.getenv('MAX_PARALLEL_DOWNLOADS', '4'))
+
+# Archives up to this size are extracted in-process with tarfile,
+# larger ones go through the external parallel decompressor
+TARFILE_MAX_SIZE = int(os.getenv('TARFILE_MAX_SIZE', str(256 * 1024**2)))
+
+# Matches sprite archives in files.txt, capturing the sprite version name
+_SPRITE_RE = re.compile(r'^sprites/([^/]+)\.tar\.gz\s*$', re.M)
+
+
+def is_nonempty_dir(path):
+    """Check if path is a directory with at least one entry, reading a single entry"""
+    try:
+        with os.scandir(path) as it:
+            return next(it, None) is not None
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+
+def decompress_command():
+    """Return the command used to decompress a gzip stream from stdin"""
+    if shutil.which('rapidgzip'):
+        return ['rapidgzip', '-d', '-c']
+    return ['pigz', '-dc']
+
+
+@contextmanager
+def extract_into_place(output_dir):
+    """
+    Yield a temp dir next to output_dir to extract into. On success its top-level
+    entries are moved into output_dir, so a failed download never leaves a partial tree
+    that later runs would take for a complete one.
+    """
+    staging_dir = Path(tempfile.mkdtemp(prefix='.extract-', dir=output_dir))
+    try:
+        yield staging_dir
+        
+        for entry in staging_dir.iterdir():
+            target = output_dir / entry.name
+            if target.is_dir() and not target.is_symlink():
+                shutil.rmtree(target)
+            elif target.exists() or target.is_symlink():
+                target.unlink()
+            entry.rename(target)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def download_and_extract(url, output_dir):
+    """Stream a tar.gz archive from url and extract it without an intermediate file"""
+    print(f"Downloading and extracting: {url}")
+    
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    with SESSION.get(url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+        size = int(response.headers.get('content-length', 0))
+        
+        with extract_into_place(output_dir) as staging_dir:
+            if 0 < size <= TARFILE_MAX_SIZE:
+                # Small archives: skip the subprocesses and decompress in-process
+                with tarfile.open(fileobj=response.raw, mode='r|gz') as tar:
+                    tar.extractall(staging_dir, filter='data')
+            else:
+                extract_stream_external(response.raw, staging_dir)
+
+
+def extract_stream_external(stream, output_dir):
+    """Extract a tar.gz stream by piping it through pigz and tar"""
+    # stream | pigz -dc | tar -x, so decompression and extraction overlap with the download
+    processes = []
+    try:
+        decompress = subprocess.Popen(
+            decompress_command(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        processes.append(decompress)
+        extract = subprocess.Popen(
+            ['tar', '-xf', '-', '-C', str(output_dir)],
+            stdin=decompress.stdout
+        )
+        processes.append(extract)
+        decompress.stdout.close()
+        
+        try:
+            shutil.copyfileobj(stream, decompress.stdin, 1024**2)
+        except BrokenPipeError:
+            # The decompressor exited early, its return code is checked below
+            pass
+        finally:
+            with suppress(BrokenPipeError):
+                decompress.stdin.close()
+    except Exception:
+        # Don't leave already started stages running if the pipeline fails
+        for process in processes:
+            process.kill()
+            process.wait()
+        raise
+    
+    for process in reversed(processes):
+        process.wait()
+    
+    for process in processes:
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
 
 
 def download_asset(asset_name, assets_dir='/data/assets'):
@@ -53,17 +143,14 @@ def download_asset(asset_name, assets_dir='/data/assets'):
     
     # Check if already downloaded
     ofm_dir = asset_dir / 'ofm'
-    if ofm_dir.exists() and any(ofm_dir.iterdir()):
+    if is_nonempty_dir(ofm_dir):
         print(f"Asset {asset_name} already exists, skipping")
         return True
     
     url = f'https://assets.openfreemap.com/{asset_name}/ofm.tar.gz'
-    archive_path = asset_dir / 'ofm.tar.gz'
     
     try:
-        download_file(url, archive_path)
-        extract_tar_gz(archive_path, asset_dir)
-        archive_path.unlink()  # Clean up archive
+        download_and_extract(url, asset_dir)
         print(f"Successfully downloaded asset: {asset_name}")
         return True
     except Exception as e:
@@ -71,6 +158,23 @@ def download_asset(asset_name, assets_dir='/data/assets'):
         return False
 
 
+def download_sprite(sprite_name, sprites_dir, cdn_url):
+    """Download and extract a single sprite version"""
+    sprite_version_dir = sprites_dir / sprite_name
+    
+    if is_nonempty_dir(sprite_version_dir):
+        print(f"Sprite version {sprite_name} already exists, skipping")
+        return
+    
+    url = f'{cdn_url}/sprites/{sprite_name}.tar.gz'
+    
+    try:
+        download_and_extract(url, sprites_dir)
+        print(f"Downloaded sprite version: {sprite_name}")
+    except Exception as e:
+        print(f"Error downloading sprite {sprite_name}: {e}")
+
+
 def download_sprites(assets_dir='/data/assets'):
     """Download all sprite versions"""
     assets_dir = Path(assets_dir)
@@ -83,33 +187,17 @@ def download_sprites(assets_dir='/data/assets'):
     cdn_url = os.getenv('ASSETS_CDN_URL', 'https://assets.openfreemap.com')
     
     try:
-        response = requests.get(f'{cdn_url}/files.txt', timeout=30)
+        response = SESSION.get(f'{cdn_url}/files.txt', timeout=30)
         response.raise_for_status()
         
         # Find all sprite archives
-        sprites_remote = [
-            line for line in response.text.splitlines()
-            if line.startswith('sprites/') and line.endswith('.tar.gz')
-        ]
+        sprite_names = _SPRITE_RE.findall(response.text)
         
-        for sprite_path in sprites_remote:
-            sprite_name = sprite_path.split('/')[1].replace('.tar.gz', '')
-            sprite_version_dir = sprites_dir / sprite_name
-            
-            if sprite_version_dir.exists() and any(sprite_version_dir.iterdir()):
-                print(f"Sprite version {sprite_name} already exists, skipping")
-                continue
-            
-            url = f'{cdn_url}/sprites/{sprite_name}.tar.gz'
-            temp_archive = sprites_dir / 'temp.tar.gz'
-            
-            try:
-                download_file(url, temp_archive)
-                extract_tar_gz(temp_archive, sprites_dir)
-                temp_archive.unlink()
-                print(f"Downloaded sprite version: {sprite_name}")
-            except Exception as e:
-                print(f"Error downloading sprite {sprite_name}: {e}")
+        # Download sprite versions in parallel, errors are reported but not fatal
+        if sprite_names:
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOADS) as pool:
+                for sprite_name in sprite_names:
+                    pool.submit(download_sprite, sprite_name, sprites_dir, cdn_url)
         
         return True
         
@@ -123,16 +211,13 @@ def download_all_assets(assets_dir='/data/assets'):
     print("Downloading OpenFreeMap assets...")
     
     assets = ['fonts', 'styles', 'natural_earth']
-    success = True
-    
-    for asset in assets:
-        if not download_asset(asset, assets_dir):
-            success = False
     
-    if not download_sprites(assets_dir):
-        success = False
+    # Download assets and sprites in parallel to overlap connection setup
+    with ThreadPoolExecutor(max_workers=len(assets) + 1) as pool:
+        futures = [pool.submit(download_asset, asset, assets_dir) for asset in assets]
+        futures.append(pool.submit(download_sprites, assets_dir))
     
-    return success
+    return all(future.result() for future in futures)
 
 
 if __name__ == '__main__':
@@ -3,14 +3,21 @@
 Extracts tiles from Btrfs image to regular filesystem
 This allows Docker containers to serve tiles without privileged mode
 """
+import json
 import os
 import subprocess
 import shutil
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
+MAX_PARALLEL_EXTRACTIONS = int(
+    os.getenv('MAX_PARALLEL_EXTRACTIONS', str(min(4, max(1, (os.cpu_count() or 1) // 2))))
+)
+
+
 def mount_btrfs(btrfs_file, mount_point):
     """Mount a Btrfs image using loop device"""
     mount_point = Path(mount_point)
@@ -18,21 +25,16 @@ def mount_btrfs(btrfs_file, mount_point):
     
     print(f"Mounting {btrfs_file} to {mount_point}")
     
-    # Find available loop device
+    # Find an available loop device and set it up in one step,
+    # so parallel extractions can't pick the same device
     result = subprocess.run(
-        ['losetup', '-f'],
+        ['losetup', '-f', '--show', str(btrfs_file)],
         capture_output=True,
         text=True,
         check=True
     )
     loop_device = result.stdout.strip()
     
-    # Setup loop device
-    subprocess.run(
-        ['losetup', loop_device, str(btrfs_file)],
-        check=True
-    )
-    
     # Mount the filesystem
     subprocess.run(
         ['mount', '-t', 'btrfs', '-o', 'ro', loop_device, str(mount_point)],
@@ -53,6 +55,56 @@ def unmount_btrfs(mount_point, loop_device):
         print(f"Warning: Error during unmount: {e}")
 
 
+def copy_tiles(tiles_dir, destination, link_dest=None):
+    """
+    Copy the tile tree out of the mounted image.
+    link_dest is a previously extracted tiles directory to hardlink unchanged tiles from.
+    """
+    destination.mkdir(parents=True, exist_ok=True)
+    
+    # Copy tiles using rsync
+    # Note: We use rsync instead of cp because it handles hardlinks better
+    cmd = [
+        'rsync',
+        '-a',  # archive mode
+        '--info=progress2',  # show progress
+    ]
+    
+    if link_dest:
+        # Tiles identical to the previous version become hardlinks to it.
+        # Every version has new mtimes, so compare content and don't preserve times,
+        # otherwise rsync never considers the files identical.
+        print(f"Hardlinking unchanged tiles from {link_dest}")
+        cmd += [
+            '--checksum',
+            '--no-times',
+            f'--link-dest={link_dest}',
+        ]
+    
+    cmd += [
+        str(tiles_dir) + '/',
+        str(destination) + '/'
+    ]
+    subprocess.run(cmd, check=True)
+
+
+def find_previous_version(output_dir, area, version):
+    """Find the tiles of the newest already extracted version older than version"""
+    area_dir = Path(output_dir) / area
+    
+    if not area_dir.exists():
+        return None
+    
+    previous_versions = sorted(
+        version_dir.name for version_dir in area_dir.iterdir()
+        if version_dir.name < version and (version_dir / 'tiles').is_dir()
+    )
+    if not previous_versions:
+        return None
+    
+    return (area_dir / previous_versions[-1] / 'tiles').resolve()
+
+
 def extract_tiles(btrfs_file, output_dir, area, version):
     """Extract tiles from Btrfs image to regular filesystem"""
     btrfs_file = Path(btrfs_file)
@@ -91,24 +143,16 @@ def extract_tiles(btrfs_file, output_dir, area, version):
             # Create output directory
             tiles_output.mkdir(parents=True, exist_ok=True)
             
-            # Copy tiles using rsync for efficiency
-            # Note: We use rsync instead of cp because it handles hardlinks better
             print(f"Copying tiles... This may take a while for planet data.")
             print(f"Source: {tiles_dir}")
             print(f"Destination: {tiles_output / 'tiles'}")
             
-            # For large datasets, we use rsync with compression
-            subprocess.run([
-                'rsync',
-                '-a',  # archive mode
-                '--info=progress2',  # show progress
-                str(tiles_dir) + '/',
-                str(tiles_output / 'tiles') + '/'
-            ], check=True)
+            link_dest = find_previous_version(output_dir, area, version)
+            copy_tiles(tiles_dir, tiles_output / 'tiles', link_dest)
             
             # Copy metadata
             if metadata_file.exists():
-                shutil.copy2(metadata_file, tiles_output / 'metadata.json')
+                shutil.copyfile(metadata_file, tiles_output / 'metadata.json')
                 print(f"Copied metadata.json")
             
             print(f"Successfully extracted tiles to {tiles_output}")
@@ -126,8 +170,84 @@ def extract_tiles(btrfs_file, output_dir, area, version):
     return False
 
 
-def extract_all_areas(btrfs_dir='/data/btrfs', tiles_dir='/data/tiles'):
-    """Extract all downloaded Btrfs images"""
+def mount_area(btrfs_file, output_dir, mounts_dir, area, version):
+    """Mount a Btrfs image read-only in place of extracting it, returns the mount point"""
+    btrfs_file = Path(btrfs_file)
+    mount_point = Path(mounts_dir) / area / version
+    tiles_output = Path(output_dir) / area / version
+    
+    if not btrfs_file.exists():
+        print(f"Error: Btrfs file not found: {btrfs_file}")
+        return None
+    
+    try:
+        if os.path.ismount(mount_point):
+            print(f"Btrfs image already mounted at {mount_point}")
+        else:
+            mount_btrfs(btrfs_file, mount_point)
+        
+        if not (mount_point / 'tiles').exists():
+            print("Error: tiles directory not found in Btrfs image")
+            return None
+        
+        # metadata.json is still copied, TileJSON is generated next to it
+        metadata_file = mount_point / 'metadata.json'
+        if metadata_file.exists():
+            tiles_output.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(metadata_file, tiles_output / 'metadata.json')
+            print("Copied metadata.json")
+        
+        print(f"Successfully mounted tiles at {mount_point}")
+        return mount_point
+    
+    except Exception as e:
+        print(f"Error during mount: {e}")
+        return None
+
+
+def write_mounts_file(mounts_dir, mounts):
+    """Record mounted areas in mounts.json for the nginx config generator"""
+    mounts_file = Path(mounts_dir) / 'mounts.json'
+    
+    # Keep entries from previous runs
+    existing = {}
+    if mounts_file.exists():
+        with open(mounts_file) as f:
+            existing = json.load(f)
+    
+    for area, versions in mounts.items():
+        existing.setdefault(area, {}).update(versions)
+    
+    mounts_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(mounts_file, 'w') as f:
+        json.dump(existing, f, indent=2)
+    
+    print(f"Wrote {mounts_file}")
+
+
+def print_processing(area, version):
+    """Print a header for the area/version being processed"""
+    print(f"\n{'='*60}")
+    print(f"Processing {area}/{version}")
+    print(f"{'='*60}")
+
+
+def extract_area_versions(area, versions, tiles_dir):
+    """Extract the given (btrfs_file, version) pairs of one area in order"""
+    success = True
+    
+    for btrfs_file, version in versions:
+        print_processing(area, version)
+        if not extract_tiles(btrfs_file, tiles_dir, area, version):
+            success = False
+    
+    return success
+
+
+def extract_all_areas(
+    btrfs_dir='/data/btrfs', tiles_dir='/data/tiles', mounts_dir='/data/mounts', mount_only=False
+):
+    """Extract all downloaded Btrfs images, or only mount them when mount_only is set"""
     btrfs_dir = Path(btrfs_dir)
     
     if not btrfs_dir.exists():
@@ -135,29 +255,47 @@ def extract_all_areas(btrfs_dir='/data/btrfs', tiles_dir='/data/tiles'):
         return False
     
     success = True
+    mounts = {}
+    work = {}
     
     # Find all Btrfs files
-    for area_dir in btrfs_dir.iterdir():
+    for area_dir in sorted(btrfs_dir.iterdir()):
         if not area_dir.is_dir() or area_dir.name.startswith('_'):
             continue
         
         area = area_dir.name
         
-        for version_dir in area_dir.iterdir():
+        for version_dir in sorted(area_dir.iterdir()):
             if not version_dir.is_dir():
                 continue
             
-            version = version_dir.name
             btrfs_file = version_dir / 'tiles.btrfs'
-            
             if btrfs_file.exists():
-                print(f"\n{'='*60}")
-                print(f"Processing {area}/{version}")
-                print(f"{'='*60}")
-                
-                if not extract_tiles(btrfs_file, tiles_dir, area, version):
+                work.setdefault(area, []).append((btrfs_file, version_dir.name))
+    
+    if mount_only:
+        for area, versions in work.items():
+            for btrfs_file, version in versions:
+                print_processing(area, version)
+                mount_point = mount_area(btrfs_file, tiles_dir, mounts_dir, area, version)
+                if mount_point:
+                    mounts.setdefault(area, {})[version] = str(mount_point)
+                else:
                     success = False
     
+    elif work:
+        # Areas are extracted in parallel, each on its own loop device.
+        # Versions of one area run in order, so each can hardlink from the previous one.
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_EXTRACTIONS) as pool:
+            futures = [
+                pool.submit(extract_area_versions, area, versions, tiles_dir)
+                for area, versions in work.items()
+            ]
+        success = all(future.result() for future in futures)
+    
+    if mounts:
+        write_mounts_file(mounts_dir, mounts)
+    
     return success
 
 
@@ -169,12 +307,16 @@ if __name__ == '__main__':
     
     btrfs_dir = os.getenv('BTRFS_DIR', '/data/btrfs')
     tiles_dir = os.getenv('TILES_DIR', '/data/tiles')
+    mounts_dir = os.getenv('MOUNTS_DIR', '/data/mounts')
+    mount_only = '--mount-only' in sys.argv or os.getenv('MOUNT_ONLY') == 'true'
     
     print("Starting tile extraction...")
     print(f"Btrfs source: {btrfs_dir}")
     print(f"Tiles output: {tiles_dir}")
+    if mount_only:
+        print(f"Mount only, mounting to: {mounts_dir}")
     
-    success = extract_all_areas(btrfs_dir, tiles_dir)
+    success = extract_all_areas(btrfs_dir, tiles_dir, mounts_dir, mount_only)
     
     if not success:
         print("\nExtraction completed with errors")
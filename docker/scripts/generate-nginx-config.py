@@ -4,55 +4,12 @@ Generates nginx configuration blocks for serving tiles
 """
 import os
 import json
+from contextlib import contextmanager, suppress
 from pathlib import Path
 
 
-def generate_tile_locations(tiles_dir='/data/tiles', domain='localhost'):
-    """Generate nginx location blocks for all tile versions"""
-    tiles_dir = Path(tiles_dir)
-    
-    if not tiles_dir.exists():
-        print(f"Tiles directory not found: {tiles_dir}")
-        return []
-    
-    configs = []
-    
-    # Find all tile directories
-    for area_dir in sorted(tiles_dir.iterdir()):
-        if not area_dir.is_dir():
-            continue
-        
-        area = area_dir.name
-        
-        for version_dir in sorted(area_dir.iterdir()):
-            if not version_dir.is_dir():
-                continue
-            
-            version = version_dir.name
-            tiles_path = version_dir / 'tiles'
-            metadata_path = version_dir / 'metadata.json'
-            tilejson_path = version_dir / 'tilejson.json'
-            
-            if not tiles_path.exists() or not metadata_path.exists():
-                continue
-            
-            # Update TileJSON with correct domain
-            if tilejson_path.exists():
-                try:
-                    with open(tilejson_path, 'r') as f:
-                        tilejson = json.load(f)
-                    
-                    # Update tiles URL
-                    protocol = 'https' if domain != 'localhost' else 'http'
-                    tilejson['tiles'] = [f'{protocol}://{domain}/{area}/{version}/{{z}}/{{x}}/{{y}}.pbf']
-                    
-                    with open(tilejson_path, 'w') as f:
-                        json.dump(tilejson, f, separators=(',', ':'))
-                except Exception as e:
-                    print(f"Error updating TileJSON: {e}")
-            
-            # Generate location block for this version
-            config = f"""# Specific version: {area}/{version}
+# Location blocks for a specific version, filled in with str.format
+VERSION_TEMPLATE = """# Specific version: {area}/{version}
 location = /{area}/{version} {{
     alias {tilejson_path};
     expires 1w;
@@ -79,37 +36,9 @@ location ^~ /{area}/{version}/ {{
     add_header x-ofm-debug 'specific PBF {area} {version}';
 }}
 """
-            configs.append((area, version, config))
-    
-    return configs
 
-
-def generate_latest_redirects(tiles_dir='/data/tiles'):
-    """Generate redirects for /area to latest version"""
-    tiles_dir = Path(tiles_dir)
-    configs = []
-    
-    for area_dir in sorted(tiles_dir.iterdir()):
-        if not area_dir.is_dir():
-            continue
-        
-        area = area_dir.name
-        
-        # Find latest version (assuming sorted order)
-        versions = sorted([v.name for v in area_dir.iterdir() if v.is_dir()])
-        if not versions:
-            continue
-        
-        latest_version = versions[-1]
-        latest_path = area_dir / latest_version
-        tiles_path = latest_path / 'tiles'
-        tilejson_path = latest_path / 'tilejson.json'
-        
-        if not tiles_path.exists() or not tilejson_path.exists():
-            continue
-        
-        # Generate latest location blocks  
-        config = f"""# Latest version redirect: {area} -> {latest_version}
+# Location blocks redirecting an area to its latest version
+LATEST_TEMPLATE = """# Latest version redirect: {area} -> {latest_version}
 location = /{area} {{
     alias {tilejson_path};
     expires 1d;
@@ -148,14 +77,165 @@ location ~ ^/{area}/([^/]+)/(.+)$ {{
     add_header x-ofm-debug 'wildcard PBF {area}';
 }}
 """
-        configs.append((area, config))
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    """
+    Open a temp file next to path and rename it over path on success,
+    so readers never see a partial file. The temp file is removed on failure.
+    """
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+
+
+def load_mounts(mounts_dir='/data/mounts'):
+    """Load mount points of read-only mounted Btrfs images, written by extract-btrfs.py"""
+    mounts_file = Path(mounts_dir) / 'mounts.json'
+    
+    if not mounts_file.exists():
+        return {}
+    
+    try:
+        with open(mounts_file) as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error reading {mounts_file}: {e}")
+        return {}
+
+
+def walk_tiles(tiles_dir='/data/tiles', mounts=None):
+    """
+    Walk tiles_dir once, yielding (area, version, version_path, tiles_path, metadata_path,
+    tilejson_path) for every version directory in sorted order.
+    Paths are plain strings, missing files are None.
+    """
+    mounts = mounts or {}
+    
+    # os.scandir gets the file type from the directory listing, avoiding a stat per entry
+    with os.scandir(tiles_dir) as it:
+        area_entries = sorted(
+            (entry for entry in it if entry.is_dir()),
+            key=lambda entry: entry.name
+        )
+    
+    for area_entry in area_entries:
+        area = area_entry.name
+        
+        with os.scandir(area_entry.path) as it:
+            version_entries = sorted(
+                (entry for entry in it if entry.is_dir()),
+                key=lambda entry: entry.name
+            )
+        
+        for version_entry in version_entries:
+            version = version_entry.name
+            version_path = version_entry.path
+            
+            with os.scandir(version_path) as it:
+                names = {entry.name for entry in it}
+            
+            # Serve tiles from the mounted image if there is one, otherwise from the extracted copy
+            mount_point = mounts.get(area, {}).get(version)
+            tiles_path = None
+            if mount_point:
+                tiles_path = os.path.join(mount_point, 'tiles')
+                if not os.path.isdir(tiles_path):
+                    print(f"Warning: mounted tiles not found for {area}/{version}: {tiles_path}")
+                    tiles_path = None
+            if not tiles_path and 'tiles' in names:
+                tiles_path = os.path.join(version_path, 'tiles')
+            
+            metadata_path = (
+                os.path.join(version_path, 'metadata.json') if 'metadata.json' in names else None
+            )
+            tilejson_path = (
+                os.path.join(version_path, 'tilejson.json') if 'tilejson.json' in names else None
+            )
+            
+            yield area, version, version_path, tiles_path, metadata_path, tilejson_path
+
+
+def write_tile_locations(f, tile_entries, domain='localhost'):
+    """Write nginx location blocks for all tile versions to f, returns the (area, version) pairs"""
+    written = []
+    
+    for area, version, version_path, tiles_path, metadata_path, tilejson_path in tile_entries:
+        if not tiles_path or not metadata_path:
+            continue
+        
+        # Update TileJSON with correct domain
+        if tilejson_path:
+            try:
+                with open(tilejson_path, 'rb') as tilejson_file:
+                    existing = tilejson_file.read()
+                tilejson = json.loads(existing)
+                
+                # Update tiles URL
+                protocol = 'https' if domain != 'localhost' else 'http'
+                tilejson['tiles'] = [f'{protocol}://{domain}/{area}/{version}/{{z}}/{{x}}/{{y}}.pbf']
+                
+                # Only rewrite the file when its content changes
+                new = json.dumps(tilejson, separators=(',', ':')).encode()
+                if new != existing:
+                    with atomic_open(tilejson_path, 'wb') as tilejson_file:
+                        tilejson_file.write(new)
+            except Exception as e:
+                print(f"Error updating TileJSON: {e}")
+        
+        # Generate location block for this version
+        if written:
+            f.write('\n')
+        f.write(VERSION_TEMPLATE.format(
+            area=area,
+            version=version,
+            tilejson_path=os.path.join(version_path, 'tilejson.json'),
+            tiles_path=tiles_path
+        ))
+        written.append((area, version))
     
-    return configs
+    return written
+
+
+def write_latest_redirects(f, tile_entries):
+    """Write redirects for /area to latest version to f, returns the areas"""
+    # Find latest version per area (entries are in sorted order)
+    latest_entries = {}
+    for entry in tile_entries:
+        latest_entries[entry[0]] = entry
+    
+    written = []
+    
+    for area, latest_version, latest_path, tiles_path, _, tilejson_path in latest_entries.values():
+        if not tiles_path or not tilejson_path:
+            continue
+        
+        # Generate latest location blocks
+        if written:
+            f.write('\n')
+        f.write(LATEST_TEMPLATE.format(
+            area=area,
+            latest_version=latest_version,
+            latest_path=latest_path,
+            tilejson_path=tilejson_path,
+            tiles_path=tiles_path
+        ))
+        written.append(area)
+    
+    return written
 
 
 def main():
     tiles_dir = os.getenv('TILES_DIR', '/data/tiles')
     domain = os.getenv('NGINX_HOST', 'localhost')
+    mounts_dir = os.getenv('MOUNTS_DIR', '/data/mounts')
     output_dir = Path('/etc/nginx/includes')
     output_dir.mkdir(parents=True, exist_ok=True)
     
@@ -163,32 +243,35 @@ def main():
     print(f"  Tiles directory: {tiles_dir}")
     print(f"  Domain: {domain}")
     
+    mounts = load_mounts(mounts_dir)
+    if mounts:
+        print(f"  Serving mounted Btrfs images from: {mounts_dir}")
+    
+    if not os.path.isdir(tiles_dir):
+        print(f"Tiles directory not found: {tiles_dir}")
+        tile_entries = []
+    else:
+        # Walk the tiles directory once for both config files
+        tile_entries = list(walk_tiles(tiles_dir, mounts))
+    
     # Generate specific version configs
-    version_configs = generate_tile_locations(tiles_dir, domain)
+    output_file = output_dir / 'tiles-versions.conf'
+    with atomic_open(output_file) as f:
+        versions = write_tile_locations(f, tile_entries, domain)
     
-    if version_configs:
-        config_content = '\n'.join(config for _, _, config in version_configs)
-        output_file = output_dir / 'tiles-versions.conf'
-        
-        with open(output_file, 'w') as f:
-            f.write(config_content)
-        
-        print(f"  Generated version configs: {len(version_configs)} versions")
-        for area, version, _ in version_configs:
+    if versions:
+        print(f"  Generated version configs: {len(versions)} versions")
+        for area, version in versions:
             print(f"    - {area}/{version}")
     
     # Generate latest redirects
-    latest_configs = generate_latest_redirects(tiles_dir)
+    output_file = output_dir / 'tiles-latest.conf'
+    with atomic_open(output_file) as f:
+        areas = write_latest_redirects(f, tile_entries)
     
-    if latest_configs:
-        config_content = '\n'.join(config for _, config in latest_configs)
-        output_file = output_dir / 'tiles-latest.conf'
-        
-        with open(output_file, 'w') as f:
-            f.write(config_content)
-        
-        print(f"  Generated latest configs: {len(latest_configs)} areas")
-        for area, _ in latest_configs:
+    if areas:
+        print(f"  Generated latest configs: {len(areas)} areas")
+        for area in areas:
             print(f"    - {area}")
     
     print("Configuration generation complete")
@@ -4,16 +4,32 @@ Downloads Btrfs images from OpenFreeMap CDN
 Supports configurable CDN URL via BTRFS_CDN_URL environment variable
 """
 import os
+import re
+import shutil
 import subprocess
 import sys
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Shared session so metadata requests reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=0.3)
+))
+
+# Matches lines like: areas/planet/20240101_120000_pt/tiles.btrfs.gz
+_VERSION_RE = re.compile(r'^areas/(\w+)/([^/]+)/tiles\.btrfs\.gz\s*$', re.M)
 
 
 def get_remote_file_size(url):
-    """Get the size of a remote file"""
+    """Get the size of a remote file, using the shared session's pooled connection"""
     try:
-        response = requests.head(url, allow_redirects=True, timeout=30)
+        response = SESSION.head(url, allow_redirects=True, timeout=30)
         if response.status_code == 200:
             return int(response.headers.get('content-length', 0))
     except Exception as e:
@@ -24,12 +40,26 @@ def get_remote_file_size(url):
 def download_file_aria2(url, output_path):
     """Download file using aria2c for better performance"""
     print(f"Downloading: {url}")
+    # Defaults are tuned for large files on a fast link, override per link via env vars
     cmd = [
         'aria2c',
-        '--max-connection-per-server=16',
-        '--split=16',
-        '--min-split-size=1M',
-        '--file-allocation=none',
+        f"--max-connection-per-server={os.getenv('ARIA2_MAX_CONNECTIONS', '16')}",
+        f"--split={os.getenv('ARIA2_SPLIT', '32')}",
+        f"--min-split-size={os.getenv('ARIA2_MIN_SPLIT_SIZE', '8M')}",
+        f"--file-allocation={os.getenv('ARIA2_FILE_ALLOCATION', 'falloc')}",
+        f"--disk-cache={os.getenv('ARIA2_DISK_CACHE', '64M')}",
+        '--enable-mmap=true',
+        '--optimize-concurrent-downloads=true',
+        # Skip unchanged files and resume partial downloads left in the temp dir
+        '--conditional-get=true',
+        '--remote-time=true',
+        '--allow-overwrite=true',
+        '--continue=true',
+        '--auto-save-interval=30',
+        '--timeout=30',
+        '--connect-timeout=30',
+        '--max-tries=5',
+        '--retry-wait=10',
         '--console-log-level=warn',
         '--summary-interval=5',
         '--download-result=hide',
@@ -40,6 +70,25 @@ def download_file_aria2(url, output_path):
     subprocess.run(cmd, check=True)
 
 
+def decompress_file(compressed_path, output_path):
+    """Decompress a gzip file, using rapidgzip for parallel decompression if available"""
+    if shutil.which('rapidgzip'):
+        # rapidgzip decompresses a single gzip stream on all cores available to the container
+        cmd = [
+            'rapidgzip',
+            '-d',
+            '-f',
+            '-P', str(len(os.sched_getaffinity(0))),
+            '-o', str(output_path),
+            str(compressed_path)
+        ]
+        subprocess.run(cmd, check=True)
+        compressed_path.unlink()
+    else:
+        # unpigz is limited to a single core for decompression
+        subprocess.run(['unpigz', '-f', str(compressed_path)], check=True)
+
+
 def get_latest_version(area='planet'):
     """Fetch the latest version for an area"""
     # Use configured CDN URL or default
@@ -48,20 +97,14 @@ def get_latest_version(area='planet'):
     print(f"Fetching available versions for {area}...")
     
     try:
-        response = requests.get(url, timeout=30)
+        response = SESSION.get(url, timeout=30)
         response.raise_for_status()
         
         # Parse files.txt to find versions
-        lines = response.text.strip().split('\n')
-        versions = []
-        
-        for line in lines:
-            if f'areas/{area}/' in line and 'tiles.btrfs.gz' in line:
-                # Extract version from path like: areas/planet/20240101_120000_pt/tiles.btrfs.gz
-                parts = line.split('/')
-                if len(parts) >= 4:
-                    version = parts[2]
-                    versions.append(version)
+        versions = [
+            version for file_area, version in _VERSION_RE.findall(response.text)
+            if file_area == area
+        ]
         
         if not versions:
             print(f"No versions found for {area}")
@@ -77,6 +120,25 @@ def get_latest_version(area='planet'):
         return None
 
 
+def remove_stale_temp(temp_root, keep_dir):
+    """Remove leftovers of interrupted downloads in temp_root, except keep_dir and its parents"""
+    if not temp_root.exists():
+        return
+    
+    keep = {keep_dir, *keep_dir.parents}
+    for path in (temp_root, keep_dir.parent):
+        if not path.exists():
+            continue
+        for child in path.iterdir():
+            if child in keep:
+                continue
+            print(f"Removing stale temp file: {child}")
+            if child.is_dir():
+                shutil.rmtree(child, ignore_errors=True)
+            else:
+                child.unlink()
+
+
 def download_area(area, version='latest', output_dir='/data/btrfs'):
     """Download and extract Btrfs image for an area"""
     output_dir = Path(output_dir)
@@ -97,8 +159,11 @@ def download_area(area, version='latest', output_dir='/data/btrfs'):
         print(f"Btrfs file already exists: {btrfs_file}")
         return True
     
-    # Create temp directory
-    temp_dir = output_dir / '_tmp'
+    # Create temp directory, one per area and version so that aria2c only
+    # ever resumes or conditionally skips a partial download of the same URL
+    temp_root = output_dir / '_tmp'
+    temp_dir = temp_root / area / version
+    remove_stale_temp(temp_root, temp_dir)
     temp_dir.mkdir(parents=True, exist_ok=True)
     
     # Use configured CDN URL or default
@@ -113,12 +178,20 @@ def download_area(area, version='latest', output_dir='/data/btrfs'):
     stat = os.statvfs(temp_dir)
     free_space = stat.f_bavail * stat.f_frsize
     
+    # The HEAD request goes through SESSION, so when files.txt was fetched to
+    # resolve 'latest' it reuses that keep-alive connection
     file_size = get_remote_file_size(url)
     if file_size == 0:
         print("Warning: Could not determine remote file size")
     else:
-        # Need 3x space: compressed + uncompressed + safety margin
-        needed_space = file_size * 3
+        # Need 3x space: compressed + uncompressed + safety margin,
+        # minus what a previous interrupted run already allocated in temp_dir
+        allocated_space = sum(
+            path.stat().st_blocks * 512 for path in temp_dir.iterdir() if path.is_file()
+        )
+        needed_space = max(file_size * 3 - allocated_space, 0)
+        if allocated_space:
+            print(f"Resuming, {allocated_space / (1024**3):.1f}GB already allocated in {temp_dir}")
         free_gb = free_space / (1024**3)
         needed_gb = needed_space / (1024**3)
         
@@ -135,15 +208,15 @@ def download_area(area, version='latest', output_dir='/data/btrfs'):
     
     # Decompress
     print("Decompressing...")
-    subprocess.run(['unpigz', str(compressed_file)], check=True)
+    decompressed_file = temp_dir / 'tiles.btrfs'
+    decompress_file(compressed_file, decompressed_file)
     
     # Move to final location
     area_version_dir.mkdir(parents=True, exist_ok=True)
-    decompressed_file = temp_dir / 'tiles.btrfs'
     decompressed_file.rename(btrfs_file)
     
     # Clean up temp
-    subprocess.run(['rm', '-rf', str(temp_dir)], check=True)
+    shutil.rmtree(temp_root, ignore_errors=True)
     
     print(f"Successfully downloaded and extracted: {btrfs_file}")
     return True